@@ -0,0 +1,104 @@
+import threading
+from queue import Queue, Empty
+from time import monotonic
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteConcernError, WriteError
+
+class _PendingInsert:
+    def __init__(self, document):
+        self.document = document
+        self.inserted_id = None
+        self.error = None
+        self.done = threading.Event()
+
+# Group commit for inserts: concurrent callers of insert() are collected by a
+# background thread for up to max_delay seconds or max_batch_size documents and
+# written with a single insert_many. Each caller still gets its own inserted id
+# or its own error. insert_many defaults to the collection's and can be
+# replaced by a callable with the same signature that does more per batch.
+class InsertCoalescer:
+    def __init__(self, collection, max_delay=0.002, max_batch_size=100, insert_many=None):
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self._collection = collection
+        self._insert_many = insert_many or collection.insert_many
+        self._max_delay = max_delay
+        self._max_batch_size = max_batch_size
+        self._queue = Queue()
+        self._closed = False
+        # makes checking _closed and queueing atomic, so nothing can be queued
+        # behind the stop marker close() puts on the queue
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='insert-coalescer', daemon=True)
+        self._thread.start()
+
+    def insert(self, document):
+        pending = _PendingInsert(document)
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError('coalescer is closed')
+            self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.inserted_id
+
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = monotonic() + self._max_delay
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - monotonic()
+            try:
+                pending = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except Empty:
+                break
+            if pending is None:
+                # close() was called; flush what we have and stop afterwards
+                self._queue.put(None)
+                break
+            batch.append(pending)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            self._flush(self._collect(first))
+
+    def _flush(self, batch):
+        documents = [p.document for p in batch]
+        try:
+            # unordered, so one bad document doesn't fail the rest of the batch
+            self._insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # raise what insert_one would have raised for this document
+            for write_error in e.details.get('writeErrors', []):
+                error_class = DuplicateKeyError if write_error.get('code') == 11000 else WriteError
+                batch[write_error['index']].error = error_class(
+                    write_error.get('errmsg'), write_error.get('code'), write_error)
+            # write concern errors are about the whole batch: the remaining
+            # documents were written but not acknowledged as requested, which
+            # insert_one reports as WriteConcernError
+            write_concern_errors = e.details.get('writeConcernErrors', [])
+            if write_concern_errors:
+                wce = write_concern_errors[0]
+                for pending in batch:
+                    if pending.error is None:
+                        pending.error = WriteConcernError(wce.get('errmsg'), wce.get('code'), wce)
+        except Exception as e:
+            for pending in batch:
+                pending.error = e
+        for pending in batch:
+            if pending.error is None:
+                # insert_many sets _id on each document before sending it
+                pending.inserted_id = pending.document['_id']
+            pending.done.set()
@@ -1,11 +1,22 @@
 import json
-from copy import deepcopy
+import sys
+import bisect
+import heapq
+import itertools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from copy import copy, deepcopy
+from concurrent.futures import ThreadPoolExecutor
 
 import pymongo
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 
 import jsonpickle
 
+from .coalescing import InsertCoalescer
+
 class Contact:
     def __init__(self, contact_id=None, firstname=None, lastname=None, birthdate=None, emails=[], phone_numbers=[], addresses=[]):
         self.contact_id = contact_id
@@ -51,10 +62,40 @@ class Address:
     def __repr__(self):
         return 'Address(%s)' % ({k: getattr(self, k) for k in ('street', 'city', 'state', 'zipcode')},)
 
+# an entry of the change feed: the latest state of a contact as of change seq,
+# or a tombstone (contact is None) if the contact was deleted
+class Change:
+    def __init__(self, seq, contact_id, contact=None):
+        self.seq = seq
+        self.contact_id = contact_id
+        self.deleted = contact is None
+        self.contact = contact
+
+    def __eq__(self, other):
+        if other is None:
+            return False
+        else:
+            return all(getattr(self, attr) == getattr(other, attr)
+                       for attr in ('seq', 'contact_id', 'deleted', 'contact'))
+
+    def __repr__(self):
+        return 'Change(%s)' % ({k: getattr(self, k) for k in ('seq', 'contact_id', 'deleted', 'contact')},)
+
 class Backend:
+    def close(self):
+        pass
+
+    def is_valid_id(self, contact_id):
+        pass
+
     def get_contact(self, contact_id):
         pass
 
+    def get_contacts(self, contact_ids):
+        # returns a list with the same length and order as contact_ids; ids
+        # that are invalid or don't exist are returned as None
+        pass
+
     def update_contact(self, contact):
         pass
 
@@ -67,45 +108,223 @@ class Backend:
     def search_contacts(self, firstname='', lastname=''):
         pass
 
+    # the *_json methods return the response body for the corresponding read
+    # (None if the contact doesn't exist); backends can override them to skip
+    # building Contact objects
+    def get_contact_json(self, contact_id):
+        contact = self.get_contact(contact_id)
+        if contact is not None:
+            return jsonpickle.dumps(contact, unpicklable=False)
+        else:
+            return None
+
+    def search_contacts_json(self, firstname='', lastname=''):
+        return jsonpickle.dumps(self.search_contacts(firstname, lastname), unpicklable=False)
+
+    def count_contacts(self, firstname='', lastname=''):
+        # number of contacts search_contacts would return
+        pass
+
+    def facet_contacts(self, firstname='', lastname=''):
+        # returns a dict with the count of contacts search_contacts would
+        # return and histograms of their firstname and lastname initials and of
+        # their address states (a contact counts once per state)
+        pass
+
+    def get_changes(self, since=0, limit=100):
+        # returns up to limit Change objects with seq > since, ordered by seq.
+        # A contact changed several times only shows up once, with its latest
+        # change
+        pass
+
+def _initial(name_lower):
+    return name_lower[:1].upper()
+
+# what count and facets need to know about a contact, sortable by name
+def _name_index_entry(contact):
+    # state isn't validated, only non-empty strings are counted
+    states = tuple(sorted({a.state for a in contact.addresses if isinstance(a.state, str) and a.state}))
+    return (contact.firstname.lower(), contact.lastname.lower(), contact.contact_id, states)
+
+def _prefix_range(entries, prefix):
+    # entries whose firstname starts with prefix are contiguous in the sorted
+    # name index; the first string after all of them is prefix with its last
+    # character incremented
+    if not prefix:
+        return 0, len(entries)
+    upper = prefix[:-1] + chr(min(ord(prefix[-1]) + 1, sys.maxunicode))
+    return bisect.bisect_left(entries, (prefix,)), bisect.bisect_left(entries, (upper,))
+
+class _FacetCounters:
+    def __init__(self):
+        self.count = 0
+        self.firstname_initials = Counter()
+        self.lastname_initials = Counter()
+        self.states = Counter()
+
+    def copy(self):
+        result = _FacetCounters()
+        result.count = self.count
+        result.firstname_initials = self.firstname_initials.copy()
+        result.lastname_initials = self.lastname_initials.copy()
+        result.states = self.states.copy()
+        return result
+
+    def add(self, entry, sign=1):
+        firstname, lastname, _, states = entry
+        self.count += sign
+        self.firstname_initials[_initial(firstname)] += sign
+        self.lastname_initials[_initial(lastname)] += sign
+        for state in states:
+            self.states[state] += sign
+
+    def to_dict(self):
+        histogram = lambda counter: {k: v for k, v in sorted(counter.items()) if v}
+        return dict(count=self.count,
+                    firstname_initials=histogram(self.firstname_initials),
+                    lastname_initials=histogram(self.lastname_initials),
+                    states=histogram(self.states))
+
+class _ReadWriteLock:
+    # any number of readers or a single writer. Waiting writers go first, so a
+    # steady stream of searches can't starve them
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+# Safe to share between threads: reads share a readers-writer lock, so they
+# never block each other, and writes take it exclusively and update the
+# structures in place. Contacts are kept in _by_id in insertion order. Change
+# seq n lives at index n - 1 of the change log; when a contact changes again
+# its previous entry is replaced by None.
 class InMemoryBackend(Backend):
     def __init__(self):
         self.next_id = 1
-        self.contacts = []
+        self._by_id = {}
+        # sorted by (firstname, lastname), with the entry of each contact id
+        # and facet counters of all contacts
+        self._name_index = []
+        self._name_index_by_id = {}
+        self._totals = _FacetCounters()
+        self._change_log = []
+        # seq of the latest change of each existing contact; ids are never
+        # reused, so deleted ones can be dropped
+        self._latest_seq = {}
+        self._lock = _ReadWriteLock()
+
+    @property
+    def contacts(self):
+        with self._lock.reading():
+            return list(self._by_id.values())
+
+    def _apply_write(self, contact_id, new_contact):
+        # must be called with the write lock held. Adds, replaces (new_contact
+        # given) or deletes (new_contact is None) a contact. Whatever can fail
+        # runs before anything is changed, so a failure leaves no half-applied
+        # write behind.
+        #
+        # The name index entry to remove is looked up by id rather than
+        # rebuilt from the stored contact: get_contact hands out the stored
+        # object, and callers may have changed its names since.
+        new_entry = _name_index_entry(new_contact) if new_contact is not None else None
+        old_entry = self._name_index_by_id.pop(contact_id, None)
+        if old_entry is not None:
+            del self._name_index[bisect.bisect_left(self._name_index, old_entry)]
+            self._totals.add(old_entry, -1)
+        if new_entry is not None:
+            bisect.insort(self._name_index, new_entry)
+            self._totals.add(new_entry)
+            self._name_index_by_id[contact_id] = new_entry
+            self._by_id[contact_id] = new_contact
+        else:
+            del self._by_id[contact_id]
+
+        seq = len(self._change_log) + 1
+        self._change_log.append(Change(seq, contact_id, new_contact))
+        previous_seq = self._latest_seq.pop(contact_id, None)
+        if previous_seq is not None:
+            self._change_log[previous_seq - 1] = None
+        if new_contact is not None:
+            self._latest_seq[contact_id] = seq
+
+    def _parse_id(self, contact_id):
+        # int() would also take True or 1.7 and turn them into 1
+        if isinstance(contact_id, bool) or not isinstance(contact_id, (int, str)):
+            return None
+        try:
+            return int(contact_id)
+        except:
+            return None
+
+    def is_valid_id(self, contact_id):
+        return self._parse_id(contact_id) is not None
 
     def add_contact(self, contact):
         new_contact = deepcopy(contact)
-        new_contact.contact_id = self.next_id
-        self.next_id += 1
-        self.contacts.append(new_contact)
+        with self._lock.writing():
+            new_contact.contact_id = self.next_id
+            self._apply_write(new_contact.contact_id, new_contact)
+            self.next_id += 1
         return new_contact.contact_id
 
     def delete_contact(self, contact_id):
-        try:
-            contact_id = int(contact_id)
-        except:
+        contact_id = self._parse_id(contact_id)
+        if contact_id is None:
             return None
-        self.contacts = [c for c in self.contacts if c.contact_id != contact_id]
+        with self._lock.writing():
+            if contact_id in self._by_id:
+                self._apply_write(contact_id, None)
 
     def update_contact(self, contact):
-        try:
-            contact_id = int(contact.contact_id)
-        except:
+        contact_id = self._parse_id(contact.contact_id)
+        if contact_id is None:
             return None
         contact = deepcopy(contact)
-        index = next((index for index, c in enumerate(self.contacts) if c.contact_id == contact_id), -1)
-        if index != -1:
-            self.contacts[index] = contact
+        contact.contact_id = contact_id
+        with self._lock.writing():
+            if contact_id in self._by_id:
+                self._apply_write(contact_id, contact)
 
     def get_contact(self, contact_id):
-        try:
-            contact_id = int(contact_id)
-        except:
-            return None
-        index = next((index for index, c in enumerate(self.contacts) if c.contact_id == contact_id), -1)
-        if index != -1:
-            return self.contacts[index]
-        else:
-            return None
+        contact_id = self._parse_id(contact_id)
+        with self._lock.reading():
+            return self._by_id.get(contact_id)
+
+    def get_contacts(self, contact_ids):
+        contact_ids = [self._parse_id(contact_id) for contact_id in contact_ids]
+        with self._lock.reading():
+            return [self._by_id.get(contact_id) for contact_id in contact_ids]
 
     def search_contacts(self, firstname='', lastname=''):
         n = lambda s: s.lower()
@@ -116,14 +335,164 @@ class InMemoryBackend(Backend):
 
         k = lambda c: (n(c.firstname), n(c.lastname))
 
-        return sorted([
-            c for c in self.contacts if f(c)
-        ], key=k)
+        with self._lock.reading():
+            matches = [c for c in self._by_id.values() if f(c)]
+        return sorted(matches, key=k)
+
+    def _matching_entries(self, firstname, lastname):
+        # must be called with the read lock held
+        start, end = _prefix_range(self._name_index, firstname.lower())
+        lastname = lastname.lower()
+        return [e for e in self._name_index[start:end] if e[1].startswith(lastname)]
+
+    def count_contacts(self, firstname='', lastname=''):
+        with self._lock.reading():
+            if not lastname:
+                start, end = _prefix_range(self._name_index, firstname.lower())
+                return end - start
+            return len(self._matching_entries(firstname, lastname))
+
+    def facet_contacts(self, firstname='', lastname=''):
+        with self._lock.reading():
+            if not (firstname or lastname):
+                return self._totals.to_dict()
+            entries = self._matching_entries(firstname, lastname)
+        totals = _FacetCounters()
+        for entry in entries:
+            totals.add(entry)
+        return totals.to_dict()
+
+    def get_changes(self, since=0, limit=100):
+        result = []
+        with self._lock.reading():
+            log = self._change_log
+            for index in range(max(since, 0), len(log)):
+                change = log[index]
+                if change is not None:
+                    result.append(change)
+                    if len(result) >= limit:
+                        break
+        return result
 
 class MongoBackend(Backend):
-    def __init__(self, db):
+    # with coalesce_writes=True concurrent add_contact calls are grouped into
+    # insert_many batches, see coalescing.InsertCoalescer. With
+    # record_changes=True writes are also recorded for get_changes, at the
+    # cost of three more round trips per write (or per coalesced batch), and
+    # MongoDB 4.2 is needed
+    def __init__(self, db, coalesce_writes=False, max_write_delay=0.002, max_write_batch_size=100,
+                 record_changes=False):
         self._db= db
         self._collection = self._db.contacts
+        self._changes = self._db.changes
+        self._counters = self._db.counters
+        self._record_changes = record_changes
+        self._coalescer = None
+        if coalesce_writes:
+            self._coalescer = InsertCoalescer(self._collection, max_write_delay, max_write_batch_size,
+                                              insert_many=self._insert_many)
+
+    def close(self):
+        if self._coalescer is not None:
+            self._coalescer.close()
+
+    def create_indexes(self):
+        self._changes.create_index([('seq', pymongo.ASCENDING)])
+
+    # How a write is recorded:
+    #  1. allocate its seq, marking it pending in the counter document
+    #  2. write the change document
+    #  3. write the contact
+    #  4. release the seq
+    # Readers only return changes below the lowest pending seq, so a reader
+    # can't page past a change that is still being written. Since the change
+    # is written before the contact, a crash can at worst leave a change for a
+    # write that didn't happen, never lose one. Pending seqs older than
+    # pending_change_timeout seconds belong to writers that died; they are
+    # ignored by readers and pruned on the next allocation, both by the
+    # server's clock.
+    pending_change_timeout = 60
+
+    def _live_pending(self):
+        cutoff = {'$subtract': ['$$NOW', self.pending_change_timeout * 1000]}
+        return {'$filter': {'input': {'$ifNull': ['$pending', []]},
+                            'cond': {'$gt': ['$$this.at', cutoff]}}}
+
+    def _allocate_seqs(self, count):
+        # returns the first of count consecutive seqs, all pending until
+        # _release_seqs is called with it
+        counter = self._counters.find_one_and_update(
+            {'_id': 'changes'},
+            [
+                {'$set': {'seq': {'$add': [{'$ifNull': ['$seq', 0]}, count]},
+                          'pending': self._live_pending()}},
+                {'$set': {'pending': {'$concatArrays': [
+                    '$pending', [{'seq': {'$subtract': ['$seq', count - 1]}, 'at': '$$NOW'}]]}}},
+            ],
+            upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return counter['seq'] - count + 1
+
+    def _release_seqs(self, first_seq):
+        self._counters.update_one({'_id': 'changes'}, {'$pull': {'pending': {'seq': first_seq}}})
+
+    def _write_change(self, contact_id, seq, deleted):
+        # the changes collection holds one document per contact with the seq
+        # of its latest change. Only move a contact's seq forward: if the
+        # filter doesn't match because a newer change is already there, the
+        # upsert fails on the duplicate _id and that's fine. Returns what
+        # _revert_change needs to undo the write
+        try:
+            previous = self._changes.find_one_and_update(
+                {'_id': contact_id, 'seq': {'$lt': seq}},
+                {'$set': {'seq': seq, 'deleted': deleted}}, upsert=True)
+        except DuplicateKeyError:
+            return None
+        return previous or {}
+
+    def _revert_change(self, contact_id, seq, previous):
+        # for writes that turned out not to match any contact; only touches
+        # the change document if nobody wrote a newer change meanwhile
+        if previous is None:
+            return
+        if previous:
+            self._changes.update_one({'_id': contact_id, 'seq': seq},
+                                     {'$set': {'seq': previous['seq'], 'deleted': previous['deleted']}})
+        else:
+            self._changes.delete_one({'_id': contact_id, 'seq': seq})
+
+    def _insert_many(self, documents, ordered=True):
+        # insert_many used for coalesced batches: one seq allocation and one
+        # bulk change write per batch
+        if not self._record_changes:
+            return self._collection.insert_many(documents, ordered=ordered)
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+        first_seq = self._allocate_seqs(len(documents))
+        try:
+            self._changes.bulk_write([
+                pymongo.UpdateOne({'_id': d['_id']}, {'$set': {'seq': first_seq + i, 'deleted': False}}, upsert=True)
+                for i, d in enumerate(documents)
+            ], ordered=False)
+            try:
+                return self._collection.insert_many(documents, ordered=ordered)
+            except BulkWriteError as e:
+                failed = [documents[error['index']]['_id'] for error in e.details.get('writeErrors', [])]
+                if failed:
+                    self._changes.delete_many({'_id': {'$in': failed}, 'seq': {'$gte': first_seq}})
+                raise
+        finally:
+            self._release_seqs(first_seq)
+
+    def _committed_seq(self):
+        # every change with a seq up to the returned one is already written
+        counter = next(self._counters.aggregate([
+            {'$match': {'_id': 'changes'}},
+            {'$project': {'seq': True, 'pending': self._live_pending()}},
+        ]), None)
+        if counter is None:
+            return 0
+        pending = [p['seq'] for p in counter['pending']]
+        return min(pending) - 1 if pending else counter['seq']
 
     def _to_dict(self, contact):
         if contact.contact_id is not None:
@@ -131,33 +500,96 @@ class MongoBackend(Backend):
         result = json.loads(jsonpickle.dumps(contact, unpicklable=False))
         result['firstname_lower'] = result['firstname'].lower()
         result['lastname_lower'] = result['lastname'].lower()
+        # computed here because $toUpper only handles ASCII
+        result['firstname_initial'] = _initial(result['firstname_lower'])
+        result['lastname_initial'] = _initial(result['lastname_lower'])
         return result
 
     def _map_contact(self, contact):
         contact['contact_id'] = str(contact.pop('_id'))
         contact.pop('firstname_lower', '')
         contact.pop('lastname_lower', '')
+        contact.pop('firstname_initial', '')
+        contact.pop('lastname_initial', '')
         return Contact.from_raw_dict(**contact)
 
+    # fields the json read path doesn't need from the server
+    _json_projection = {'firstname_lower': False, 'lastname_lower': False,
+                        'firstname_initial': False, 'lastname_initial': False, 'contact_id': False}
+
+    def _map_contact_json(self, contact):
+        # same keys and defaults as the Contact built by _map_contact, ready
+        # for _dumps
+        get = contact.get
+        return {
+            'contact_id': str(contact['_id']),
+            'firstname': get('firstname'),
+            'lastname': get('lastname'),
+            'birthdate': get('birthdate'),
+            'emails': get('emails', []),
+            'phone_numbers': get('phone_numbers', []),
+            'addresses': [{
+                'street': a.get('street', ''),
+                'city': a.get('city', ''),
+                'state': a.get('state', ''),
+                'zipcode': a.get('zipcode', ''),
+            } for a in get('addresses', [])],
+        }
+
     def all_contacts(self):
         return [self._map_contact(c) for c in self._collection.find({})]
 
     def add_contact(self, contact):
         dict_repr = self._to_dict(contact)
-        contact_id = self._collection.insert_one(dict_repr).inserted_id
+        if self._coalescer is not None:
+            contact_id = self._coalescer.insert(dict_repr)
+        elif self._record_changes:
+            contact_id = dict_repr['_id'] = ObjectId()
+            seq = self._allocate_seqs(1)
+            try:
+                previous = self._write_change(contact_id, seq, False)
+                try:
+                    self._collection.insert_one(dict_repr)
+                except PyMongoError as e:
+                    if isinstance(e, OperationFailure):
+                        self._revert_change(contact_id, seq, previous)
+                    raise
+            finally:
+                self._release_seqs(seq)
+        else:
+            contact_id = self._collection.insert_one(dict_repr).inserted_id
         return str(contact_id)
 
-    def delete_contact(self, contact_id):
+    def _parse_id(self, contact_id):
+        # ObjectId(None) would generate a brand new id
+        if not isinstance(contact_id, (str, ObjectId)):
+            return None
         try:
-            contact_id = ObjectId(contact_id)
+            return ObjectId(contact_id)
         except:
             return None
-        self._collection.delete_one({'_id': contact_id})
 
-    def get_contact(self, contact_id):
+    def is_valid_id(self, contact_id):
+        return self._parse_id(contact_id) is not None
+
+    def delete_contact(self, contact_id):
+        contact_id = self._parse_id(contact_id)
+        if contact_id is None:
+            return None
+        if not self._record_changes:
+            self._collection.delete_one({'_id': contact_id})
+            return
+        seq = self._allocate_seqs(1)
         try:
-            contact_id = ObjectId(contact_id)
-        except:
+            previous = self._write_change(contact_id, seq, True)
+            if not self._collection.delete_one({'_id': contact_id}).deleted_count:
+                self._revert_change(contact_id, seq, previous)
+        finally:
+            self._release_seqs(seq)
+
+    def get_contact(self, contact_id):
+        contact_id = self._parse_id(contact_id)
+        if contact_id is None:
             return None
         result = self._collection.find_one({'_id': contact_id})
         if result is not None:
@@ -165,15 +597,36 @@ class MongoBackend(Backend):
         else:
             return None
 
+    def get_contacts(self, contact_ids):
+        object_ids = [self._parse_id(contact_id) for contact_id in contact_ids]
+        valid_ids = list({oid for oid in object_ids if oid is not None})
+        found = {}
+        if valid_ids:
+            for c in self._collection.find({'_id': {'$in': valid_ids}}):
+                contact = self._map_contact(c)
+                found[contact.contact_id] = contact
+        return [found.get(str(oid)) if oid is not None else None for oid in object_ids]
+
     def update_contact(self, contact):
         dict_repr = self._to_dict(contact)
-        try:
-            contact_id = ObjectId(dict_repr.pop('contact_id'))
-        except:
+        contact_id = self._parse_id(dict_repr.pop('contact_id'))
+        if contact_id is None:
             return None
-        self._collection.find_one_and_replace({'_id': contact_id}, dict_repr)
+        if not self._record_changes:
+            self._collection.find_one_and_replace({'_id': contact_id}, dict_repr)
+            return
+        seq = self._allocate_seqs(1)
+        try:
+            previous = self._write_change(contact_id, seq, False)
+            if self._collection.find_one_and_replace({'_id': contact_id}, dict_repr) is None:
+                self._revert_change(contact_id, seq, previous)
+        finally:
+            self._release_seqs(seq)
 
     def search_contacts(self, firstname='', lastname=''):
+        return [self._map_contact(c) for c in self._search_cursor(firstname, lastname)]
+
+    def _search_query(self, firstname, lastname):
         # reason to use firstname_lower and lastname_lower:
         # https://docs.mongodb.com/manual/reference/operator/query/regex/
         # "Case insensitive regular expression queries generally cannot use indexes effectively.
@@ -184,4 +637,207 @@ class MongoBackend(Backend):
             query['firstname_lower'] = { '$regex': '^%s' % firstname.lower() }
         if lastname:
             query['lastname_lower'] = { '$regex': '^%s' % lastname.lower() }
-        return [self._map_contact(c) for c in self._collection.find(query).sort([("firstname_lower", pymongo.ASCENDING), ("lastname_lower", pymongo.ASCENDING)])]
+        return query
+
+    def _search_cursor(self, firstname, lastname, projection=None):
+        query = self._search_query(firstname, lastname)
+        return self._collection.find(query, projection).sort([("firstname_lower", pymongo.ASCENDING), ("lastname_lower", pymongo.ASCENDING)])
+
+    @staticmethod
+    def _dumps(o):
+        # the mapped documents only hold json types, so they skip jsonpickle's
+        # flattening. jsonpickle 0.9.5 calls json.dumps with sort_keys=True and
+        # the default separators, which gives the same bytes
+        return json.dumps(o, sort_keys=True)
+
+    def get_contact_json(self, contact_id):
+        contact_id = self._parse_id(contact_id)
+        if contact_id is None:
+            return None
+        result = self._collection.find_one({'_id': contact_id}, self._json_projection)
+        if result is not None:
+            return self._dumps(self._map_contact_json(result))
+        else:
+            return None
+
+    def search_contacts_json(self, firstname='', lastname=''):
+        cursor = self._search_cursor(firstname, lastname, self._json_projection)
+        return self._dumps([self._map_contact_json(c) for c in cursor])
+
+    def count_contacts(self, firstname='', lastname=''):
+        return self._collection.count_documents(self._search_query(firstname, lastname))
+
+    def facet_contacts(self, firstname='', lastname=''):
+        # documents written before the initials were stored fall back to
+        # $toUpper, which is only right for ASCII
+        initial = lambda name: {'$ifNull': ['$%s_initial' % name,
+                                            {'$toUpper': {'$substrCP': ['$%s_lower' % name, 0, 1]}}]}
+        pipeline = [
+            {'$match': self._search_query(firstname, lastname)},
+            {'$facet': {
+                'count': [{'$count': 'n'}],
+                'firstname_initials': [
+                    {'$group': {'_id': initial('firstname'), 'n': {'$sum': 1}}},
+                ],
+                'lastname_initials': [
+                    {'$group': {'_id': initial('lastname'), 'n': {'$sum': 1}}},
+                ],
+                'states': [
+                    # a contact counts once per state, even with several
+                    # addresses there
+                    {'$project': {'state': {'$setUnion': ['$addresses.state', []]}}},
+                    {'$unwind': '$state'},
+                    # $expr because a plain {'$type': 'string'} also
+                    # matches arrays that contain a string
+                    {'$match': {'$expr': {'$and': [{'$eq': [{'$type': '$state'}, 'string']},
+                                                   {'$ne': ['$state', '']}]}}},
+                    {'$group': {'_id': '$state', 'n': {'$sum': 1}}},
+                ],
+            }},
+        ]
+        facets = next(self._collection.aggregate(pipeline))
+        histogram = lambda groups: {g['_id']: g['n'] for g in sorted(groups, key=lambda g: g['_id'])}
+        return dict(count=facets['count'][0]['n'] if facets['count'] else 0,
+                    firstname_initials=histogram(facets['firstname_initials']),
+                    lastname_initials=histogram(facets['lastname_initials']),
+                    states=histogram(facets['states']))
+
+    def get_changes(self, since=0, limit=100):
+        if not self._record_changes:
+            raise NotImplementedError('changes are not recorded, see record_changes')
+        committed_seq = self._committed_seq()
+        changes = list(self._changes.find({'seq': {'$gt': since, '$lte': committed_seq}})
+                       .sort([('seq', pymongo.ASCENDING)]).limit(limit))
+        live_ids = [c['_id'] for c in changes if not c['deleted']]
+        contacts = dict(zip(live_ids, self.get_contacts(live_ids)))
+        # a contact deleted after its change was read comes back as None and
+        # is reported as deleted; its tombstone follows with a later seq
+        return [Change(c['seq'], str(c['_id']), None if c['deleted'] else contacts[c['_id']])
+                for c in changes]
+
+# ids handed out by this backend have the form '<shard>-<shard id>', so single
+# contact operations go straight to the shard that owns the contact. Searches
+# run on every shard in parallel and the already sorted partial results are
+# merged.
+class ShardedBackend(Backend):
+    def __init__(self, shards):
+        if not shards:
+            raise ValueError('at least one shard is required')
+        self._shards = list(shards)
+        self._counter = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=len(self._shards))
+
+    def _make_id(self, shard_index, shard_id):
+        return '%d-%s' % (shard_index, shard_id)
+
+    def _split_id(self, contact_id):
+        try:
+            shard_index, shard_id = str(contact_id).split('-', 1)
+            shard_index = int(shard_index)
+        except ValueError:
+            return None, None
+        if not 0 <= shard_index < len(self._shards):
+            return None, None
+        return shard_index, shard_id
+
+    def _choose_shard(self):
+        # new contacts have no id yet, so they are spread round-robin; this
+        # keeps the shards balanced no matter the names
+        return next(self._counter) % len(self._shards)
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self._shards:
+            shard.close()
+
+    def _map_contact(self, shard_index, contact):
+        result = copy(contact)
+        result.contact_id = self._make_id(shard_index, contact.contact_id)
+        return result
+
+    def add_contact(self, contact):
+        shard_index = self._choose_shard()
+        shard_id = self._shards[shard_index].add_contact(contact)
+        return self._make_id(shard_index, shard_id)
+
+    def delete_contact(self, contact_id):
+        shard_index, shard_id = self._split_id(contact_id)
+        if shard_index is None:
+            return None
+        self._shards[shard_index].delete_contact(shard_id)
+
+    def update_contact(self, contact):
+        shard_index, shard_id = self._split_id(contact.contact_id)
+        if shard_index is None:
+            return None
+        contact = copy(contact)
+        contact.contact_id = shard_id
+        self._shards[shard_index].update_contact(contact)
+
+    def is_valid_id(self, contact_id):
+        shard_index, shard_id = self._split_id(contact_id)
+        return shard_index is not None and self._shards[shard_index].is_valid_id(shard_id)
+
+    def get_contact(self, contact_id):
+        shard_index, shard_id = self._split_id(contact_id)
+        if shard_index is None:
+            return None
+        result = self._shards[shard_index].get_contact(shard_id)
+        if result is not None:
+            return self._map_contact(shard_index, result)
+        else:
+            return None
+
+    def get_contacts(self, contact_ids):
+        # one multi-key lookup per shard, then put the results back in the
+        # requested order
+        positions = [[] for _ in self._shards]
+        shard_ids = [[] for _ in self._shards]
+        for position, contact_id in enumerate(contact_ids):
+            shard_index, shard_id = self._split_id(contact_id)
+            if shard_index is not None:
+                positions[shard_index].append(position)
+                shard_ids[shard_index].append(shard_id)
+
+        def lookup(shard_index):
+            if not shard_ids[shard_index]:
+                return []
+            return self._shards[shard_index].get_contacts(shard_ids[shard_index])
+
+        result = [None] * len(contact_ids)
+        partial_results = self._executor.map(lookup, range(len(self._shards)))
+        for shard_index, contacts in enumerate(partial_results):
+            for position, contact in zip(positions[shard_index], contacts):
+                if contact is not None:
+                    result[position] = self._map_contact(shard_index, contact)
+        return result
+
+    def search_contacts(self, firstname='', lastname=''):
+        search = lambda shard: shard.search_contacts(firstname, lastname)
+        partial_results = self._executor.map(search, self._shards)
+        mapped = [
+            [self._map_contact(index, c) for c in contacts]
+            for index, contacts in enumerate(partial_results)
+        ]
+        k = lambda c: (c.firstname.lower(), c.lastname.lower())
+        return list(heapq.merge(*mapped, key=k))
+
+    def get_changes(self, since=0, limit=100):
+        # every shard has its own change seq; a single integer cursor can't
+        # page through all of them
+        raise NotImplementedError('the change feed is not available for sharded backends')
+
+    def count_contacts(self, firstname='', lastname=''):
+        count = lambda shard: shard.count_contacts(firstname, lastname)
+        return sum(self._executor.map(count, self._shards))
+
+    def facet_contacts(self, firstname='', lastname=''):
+        facet = lambda shard: shard.facet_contacts(firstname, lastname)
+        result = dict(count=0, firstname_initials=Counter(), lastname_initials=Counter(), states=Counter())
+        for facets in self._executor.map(facet, self._shards):
+            result['count'] += facets['count']
+            for key in ('firstname_initials', 'lastname_initials', 'states'):
+                result[key].update(facets[key])
+        for key in ('firstname_initials', 'lastname_initials', 'states'):
+            result[key] = dict(sorted(result[key].items()))
+        return result
@@ -23,7 +23,43 @@ dumps = lambda o: jsonpickle.dumps(o, unpicklable=False)
 def search_contacts():
     firstname = request.args.get('firstname', '')
     lastname= request.args.get('lastname', '')
-    return make_response(dumps(_db().search_contacts(firstname, lastname)))
+    return make_response(_db().search_contacts_json(firstname, lastname))
+
+@app.route('/search/contacts/count/', methods=['GET'])
+def count_contacts():
+    firstname = request.args.get('firstname', '')
+    lastname= request.args.get('lastname', '')
+    return make_response(dumps({'count': _db().count_contacts(firstname, lastname)}))
+
+@app.route('/search/contacts/facets/', methods=['GET'])
+def facet_contacts():
+    firstname = request.args.get('firstname', '')
+    lastname= request.args.get('lastname', '')
+    return make_response(dumps(_db().facet_contacts(firstname, lastname)))
+
+@app.route('/contacts/<contact_id>/', methods=['GET'])
+def get_contact(contact_id):
+    result = _db().get_contact_json(contact_id)
+    if result is not None:
+        return make_response(result)
+    else:
+        return make_response(dumps({'ok': False}), 404)
+
+@app.route('/changes/', methods=['GET'])
+def get_changes():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return make_response(dumps(dict(error='invalid input - since and limit must be integers')), 400)
+    if since < 0 or not 0 < limit <= 1000:
+        return make_response(dumps(dict(error='invalid input - since or limit out of range')), 400)
+    try:
+        changes = _db().get_changes(since, limit)
+    except NotImplementedError:
+        return make_response(dumps(dict(error='change feed not available for this backend')), 501)
+    last_seq = changes[-1].seq if changes else since
+    return make_response(dumps(dict(changes=changes, last_seq=last_seq)))
 
 @app.route('/contacts/', methods=['POST'])
 def add_contact():
@@ -43,6 +79,30 @@ def add_contact():
     new_id = _db().add_contact(new_contact)
     return make_response(dumps(new_id))
 
+@app.route('/contacts/batch-get/', methods=['POST'])
+def batch_get_contacts():
+    try:
+        raw = json.loads(request.data)
+    except JSONDecodeError:
+        return make_response(dumps(dict(error='invalid input - not json')), 400)
+    if not isinstance(raw, dict) or not isinstance(raw.get('ids'), list):
+        return make_response(dumps(dict(error='invalid input - ids must be a list')), 400)
+    ids = raw['ids']
+    if len(ids) > 1000:
+        return make_response(dumps(dict(error='invalid input - at most 1000 ids')), 400)
+    db = _db()
+    contacts = []
+    missing = []
+    invalid = []
+    for contact_id, contact in zip(ids, db.get_contacts(ids)):
+        if contact is not None:
+            contacts.append(contact)
+        elif db.is_valid_id(contact_id):
+            missing.append(contact_id)
+        else:
+            invalid.append(contact_id)
+    return make_response(dumps(dict(contacts=contacts, missing=missing, invalid=invalid)))
+
 @app.route('/contacts/<contact_id>/', methods=['PUT'])
 def edit_contact(contact_id):
     try:
@@ -0,0 +1,385 @@
+"""Concurrent load generator for the contacts manager API.
+
+By default the app is started in-process on a free port with an
+InMemoryBackend; use --backend mongo to run it against a local Mongo, or --url
+to hit a server that is already running. Workers send a weighted mix of
+requests for --duration seconds, either as fast as they can or paced to a
+total --rate, and the run is summarized per route.
+
+With --server-mode process the app runs in a child process, so it doesn't
+compete with the workers for the GIL. That is the default when comparing
+against a --baseline, since numbers from a shared interpreter say as much
+about the load generator as about the server.
+
+    python loadtest.py --concurrency 16 --duration 10 --mix search=50,batch_get=30,add=10,update=5,delete=5
+    python loadtest.py --save baseline.json
+    python loadtest.py --baseline baseline.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+ROUTES = ('search', 'batch_get', 'changes', 'add', 'update', 'delete')
+DEFAULT_MIX = 'search=50,batch_get=25,changes=5,add=10,update=5,delete=5'
+NAMES = ['Ana', 'Bruno', 'Carla', 'Daniel', 'Eva', 'Fabio', 'Gina', 'Hugo', 'Iris', 'Joao']
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        route, weight = item.split('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise ValueError('unknown route %s' % route)
+        mix[route] = float(weight)
+        if mix[route] < 0:
+            raise ValueError('negative weight for %s' % route)
+    if not any(mix.values()):
+        raise ValueError('mix must have a positive weight')
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    # nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def new_contact(rnd):
+    return {
+        'firstname': rnd.choice(NAMES),
+        'lastname': rnd.choice(NAMES) + 's',
+        'emails': ['load@test.com'],
+        'phone_numbers': ['55-31-1234-4321'],
+        'birthdate': '1980-01-01',
+        'addresses': [{'street': 'street', 'city': 'city', 'state': 'AL', 'zipcode': '12345'}],
+    }
+
+
+class Client:
+    # keeps one connection open across requests; not thread safe, so every
+    # worker gets its own
+    def __init__(self, base_url, timeout=10):
+        url = urlsplit(base_url)
+        self._connection = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+        self._prefix = url.path.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        try:
+            self._connection.request(method, self._prefix + path, body=data,
+                                     headers={'Content-Type': 'application/json'})
+            response = self._connection.getresponse()
+            content = response.read()
+        except (http.client.HTTPException, OSError):
+            # reconnect on the next request
+            self._connection.close()
+            raise
+        if response.status >= 400:
+            return response.status, None
+        return response.status, json.loads(content)
+
+    def close(self):
+        self._connection.close()
+
+
+class IdPool:
+    # ids of contacts known to exist, shared by all workers
+    def __init__(self):
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def add(self, contact_id):
+        with self._lock:
+            self._ids.append(contact_id)
+
+    def sample(self, rnd, k):
+        with self._lock:
+            return rnd.sample(self._ids, min(k, len(self._ids)))
+
+    def take(self, rnd):
+        with self._lock:
+            if not self._ids:
+                return None
+            index = rnd.randrange(len(self._ids))
+            self._ids[index], self._ids[-1] = self._ids[-1], self._ids[index]
+            return self._ids.pop()
+
+
+class Recorder:
+    def __init__(self):
+        self._latencies = {route: [] for route in ROUTES}
+        self._errors = {route: 0 for route in ROUTES}
+        self._lock = threading.Lock()
+
+    def record(self, route, latency, ok):
+        with self._lock:
+            self._latencies[route].append(latency)
+            if not ok:
+                self._errors[route] += 1
+
+    def summary(self, elapsed):
+        routes = {}
+        for route in ROUTES:
+            latencies = sorted(self._latencies[route])
+            if not latencies:
+                continue
+            ms = lambda seconds: round(seconds * 1000, 3)
+            routes[route] = {
+                'requests': len(latencies),
+                'throughput': round(len(latencies) / elapsed, 2),
+                'error_rate': round(self._errors[route] / len(latencies), 4),
+                'p50_ms': ms(percentile(latencies, 0.50)),
+                'p95_ms': ms(percentile(latencies, 0.95)),
+                'p99_ms': ms(percentile(latencies, 0.99)),
+                'max_ms': ms(latencies[-1]),
+            }
+        total = sum(r['requests'] for r in routes.values())
+        return {
+            'elapsed': round(elapsed, 3),
+            'requests': total,
+            'throughput': round(total / elapsed, 2),
+            'routes': routes,
+        }
+
+
+def run_operation(route, client, pool, rnd):
+    # returns whether the request succeeded
+    if route == 'search':
+        firstname = rnd.choice(NAMES)[:rnd.randint(0, 2)].lower()
+        status, _ = client.request('GET', '/search/contacts/?firstname=%s' % firstname)
+        return status == 200
+    elif route == 'batch_get':
+        status, _ = client.request('POST', '/contacts/batch-get/', {'ids': pool.sample(rnd, 20)})
+        return status == 200
+    elif route == 'changes':
+        status, _ = client.request('GET', '/changes/?since=%d&limit=100' % rnd.randint(0, 1000))
+        return status == 200
+    elif route == 'add':
+        status, contact_id = client.request('POST', '/contacts/', new_contact(rnd))
+        if status == 200:
+            pool.add(contact_id)
+        return status == 200
+    elif route == 'update':
+        ids = pool.sample(rnd, 1)
+        if not ids:
+            return True
+        contact = dict(new_contact(rnd), contact_id=ids[0])
+        status, _ = client.request('PUT', '/contacts/%s/' % ids[0], contact)
+        # another worker may have deleted it meanwhile
+        return status in (200, 404)
+    elif route == 'delete':
+        contact_id = pool.take(rnd)
+        if contact_id is None:
+            return True
+        status, _ = client.request('DELETE', '/contacts/%s/' % contact_id)
+        return status == 200
+
+
+def run_load(base_url, mix, concurrency=8, duration=10.0, rate=None, seed_contacts=200):
+    client = Client(base_url)
+    pool = IdPool()
+    rnd = random.Random(0)
+    for _ in range(seed_contacts):
+        status, contact_id = client.request('POST', '/contacts/', new_contact(rnd))
+        if status == 200:
+            pool.add(contact_id)
+    client.close()
+
+    recorder = Recorder()
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    # with a target rate each worker sends one request every `interval` seconds
+    interval = concurrency / rate if rate else 0
+    start = time.monotonic()
+    deadline = start + duration
+
+    def worker(index):
+        rnd = random.Random(index + 1)
+        client = Client(base_url)
+        next_send = start + rnd.random() * interval
+        while True:
+            if interval:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                # latency counts from when the request was due, not from when
+                # it was actually sent, so time spent waiting on a server that
+                # fell behind shows up in the percentiles
+                began = next_send
+                next_send += interval
+            else:
+                began = time.monotonic()
+            if time.monotonic() >= deadline:
+                client.close()
+                return
+            route = rnd.choices(routes, weights)[0]
+            try:
+                ok = run_operation(route, client, pool, rnd)
+            except (http.client.HTTPException, OSError, ValueError):
+                ok = False
+            recorder.record(route, time.monotonic() - began, ok)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.monotonic() - start)
+
+
+def compare(baseline, current, tolerance=0.1):
+    # returns a list of human readable regressions, empty if there are none
+    regressions = []
+    for route, base in baseline['routes'].items():
+        now = current['routes'].get(route)
+        if now is None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if now[key] > base[key] * (1 + tolerance):
+                regressions.append('%s %s: %.3f -> %.3f' % (route, key, base[key], now[key]))
+        if now['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('%s throughput: %.2f -> %.2f' % (route, base['throughput'], now['throughput']))
+        if now['error_rate'] > base['error_rate'] + 0.01:
+            regressions.append('%s error_rate: %.4f -> %.4f' % (route, base['error_rate'], now['error_rate']))
+    return regressions
+
+
+def start_server(backend_name, mongo_uri, coalesce_writes=False):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    from contactsmanager.server import app
+    from contactsmanager.model import InMemoryBackend, MongoBackend
+
+    if backend_name == 'mongo':
+        from pymongo import MongoClient
+        mongo = MongoClient(mongo_uri)
+        mongo.drop_database('contactsmanager_loadtest')
+        backend = MongoBackend(mongo.contactsmanager_loadtest, coalesce_writes=coalesce_writes,
+                               record_changes=True)
+        backend.create_indexes()
+    else:
+        backend = InMemoryBackend()
+    app.config['BACKEND'] = backend
+    # the per request access log would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # werkzeug answers with HTTP/1.0 by default, closing the connection the
+    # client keeps open after every response
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+class ServerProcess:
+    # the app started by `loadtest.py --serve` in a child process
+    def __init__(self, backend_name, mongo_uri, coalesce_writes=False):
+        command = [sys.executable, os.path.abspath(__file__), '--serve',
+                   '--backend', backend_name, '--mongo-uri', mongo_uri]
+        if coalesce_writes:
+            command.append('--coalesce-writes')
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+        # the child prints its url once it is listening
+        self.url = self._process.stdout.readline().strip()
+        if not self.url:
+            self._process.wait()
+            raise RuntimeError('server process exited with %d' % self._process.returncode)
+
+    def shutdown(self):
+        self._process.terminate()
+
+    def server_close(self):
+        self._process.wait()
+        self._process.stdout.close()
+
+
+def serve(backend_name, mongo_uri, coalesce_writes=False):
+    server, url = start_server(backend_name, mongo_uri, coalesce_writes)
+    print(url, flush=True)
+    # requests are served by start_server's thread until the parent
+    # terminates us
+    threading.Event().wait()
+
+
+def print_summary(summary):
+    print('%d requests in %.1fs, %.1f req/s' % (summary['requests'], summary['elapsed'], summary['throughput']))
+    header = '%-10s %9s %9s %7s %9s %9s %9s %9s'
+    print(header % ('route', 'requests', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for route, r in summary['routes'].items():
+        print('%-10s %9d %9.1f %6.2f%% %9.2f %9.2f %9.2f %9.2f' % (
+            route, r['requests'], r['throughput'], r['error_rate'] * 100,
+            r['p50_ms'], r['p95_ms'], r['p99_ms'], r['max_ms']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the contacts manager API.')
+    parser.add_argument('--url', help='target an already running server instead of starting one')
+    parser.add_argument('--backend', choices=('memory', 'mongo'), default='memory')
+    parser.add_argument('--mongo-uri', default='mongodb://127.0.0.1:27017')
+    parser.add_argument('--coalesce-writes', action='store_true',
+                        help='group concurrent inserts into insert_many batches (mongo backend only)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--rate', type=float, help='target total requests per second')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed-contacts', type=int, default=200)
+    parser.add_argument('--save', help='write the summary as json to this file')
+    parser.add_argument('--baseline', help='compare against a summary saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--server-mode', choices=('thread', 'process'),
+                        help='run the app in a thread of this process or in a child process '
+                             '(default: process with --baseline, thread otherwise)')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.backend, args.mongo_uri, args.coalesce_writes)
+        return 0
+
+    server = None
+    url = args.url
+    if url is None:
+        server_mode = args.server_mode or ('process' if args.baseline else 'thread')
+        if server_mode == 'process':
+            server = ServerProcess(args.backend, args.mongo_uri, args.coalesce_writes)
+            url = server.url
+        else:
+            server, url = start_server(args.backend, args.mongo_uri, args.coalesce_writes)
+    try:
+        summary = run_load(url, parse_mix(args.mix), args.concurrency, args.duration,
+                           args.rate, args.seed_contacts)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    print_summary(summary)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), summary, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
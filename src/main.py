@@ -5,7 +5,9 @@ from contactsmanager.model import MongoBackend
 
 if __name__ == '__main__':
     mongo = MongoClient('mongodb://127.0.0.1:27017')
+    backend = MongoBackend(mongo.contactsmanager, record_changes=True)
+    backend.create_indexes()
     app.config.update(dict(
-        BACKEND=MongoBackend(mongo.contactsmanager)
+        BACKEND=backend
     ))
     app.run()
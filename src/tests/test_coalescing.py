@@ -0,0 +1,161 @@
+import unittest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteConcernError, WriteError
+
+from contactsmanager.coalescing import InsertCoalescer
+
+
+class RecordingCollection:
+    # just enough of a pymongo collection for InsertCoalescer
+    def __init__(self):
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def insert_many(self, documents, ordered=True):
+        with self._lock:
+            self.batches.append(len(documents))
+        errors = []
+        for index, document in enumerate(documents):
+            document['_id'] = ObjectId()
+            if document.get('fail'):
+                errors.append({'index': index, 'code': 11000, 'errmsg': 'duplicate key'})
+            elif document.get('invalid'):
+                errors.append({'index': index, 'code': 121, 'errmsg': 'document failed validation'})
+        write_concern_errors = [{'code': 64, 'errmsg': 'waiting for replication timed out'}]\
+            if any(d.get('wce') for d in documents) else []
+        if errors or write_concern_errors:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': write_concern_errors})
+
+
+class RoundTripCollection:
+    # a server that handles one request at a time, where each round trip
+    # costs much more than each extra document in it
+    def __init__(self, round_trip=0.002, per_document=0.00002):
+        self._round_trip = round_trip
+        self._per_document = per_document
+        self._server = threading.Lock()
+
+    def insert_one(self, document):
+        self.insert_many([document])
+
+    def insert_many(self, documents, ordered=True):
+        with self._server:
+            time.sleep(self._round_trip + self._per_document * len(documents))
+        for document in documents:
+            document['_id'] = ObjectId()
+
+
+class InsertCoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = RecordingCollection()
+        self.coalescer = InsertCoalescer(self.collection, max_delay=0.05, max_batch_size=10)
+
+    def tearDown(self):
+        self.coalescer.close()
+
+    def test_single_insert(self):
+        document = {'n': 1}
+        inserted_id = self.coalescer.insert(document)
+        self.assertEqual(document['_id'], inserted_id)
+        self.assertEqual([1], self.collection.batches)
+
+    def test_concurrent_inserts_are_batched(self):
+        documents = [{'n': i} for i in range(30)]
+        with ThreadPoolExecutor(max_workers=30) as executor:
+            ids = list(executor.map(self.coalescer.insert, documents))
+        self.assertEqual([d['_id'] for d in documents], ids)
+        self.assertEqual(30, len(set(ids)))
+        self.assertEqual(30, sum(self.collection.batches))
+        self.assertLess(len(self.collection.batches), 30)
+        self.assertTrue(all(size <= 10 for size in self.collection.batches))
+
+    def test_errors_go_to_their_caller(self):
+        documents = [{'n': i, 'fail': i == 3, 'invalid': i == 4} for i in range(6)]
+
+        def insert(document):
+            try:
+                return self.coalescer.insert(document)
+            except WriteError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(insert, documents))
+        for document, result in zip(documents, results):
+            if document['fail']:
+                # same exceptions insert_one raises
+                self.assertIsInstance(result, DuplicateKeyError)
+                self.assertEqual(11000, result.code)
+            elif document['invalid']:
+                self.assertIs(type(result), WriteError)
+                self.assertEqual(121, result.code)
+            else:
+                self.assertEqual(document['_id'], result)
+
+    def test_write_concern_errors_go_to_every_caller(self):
+        documents = [{'n': 0, 'fail': True, 'wce': True}, {'n': 1}]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(self.coalescer.insert, d) for d in documents]
+        self.assertIsInstance(futures[0].exception(), DuplicateKeyError)
+        self.assertIsInstance(futures[1].exception(), WriteConcernError)
+
+    def test_close_while_inserting(self):
+        results = []
+
+        def insert():
+            try:
+                results.append(self.coalescer.insert({'n': 1}))
+            except RuntimeError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=insert) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        self.coalescer.close()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(50, len(results))
+        inserted = sum(1 for r in results if not isinstance(r, RuntimeError))
+        self.assertEqual(inserted, sum(self.collection.batches))
+
+    def test_throughput(self):
+        inserts = 200
+
+        def run(insert):
+            documents = [{'n': i} for i in range(inserts)]
+            began = time.monotonic()
+            with ThreadPoolExecutor(max_workers=50) as executor:
+                list(executor.map(insert, documents))
+            return inserts / (time.monotonic() - began)
+
+        collection = RoundTripCollection()
+        direct = run(collection.insert_one)
+        coalescer = InsertCoalescer(collection, max_delay=0.002, max_batch_size=100)
+        try:
+            coalesced = run(coalescer.insert)
+        finally:
+            coalescer.close()
+        self.assertGreater(coalesced, direct * 3)
+
+    def test_insert_after_close(self):
+        self.coalescer.close()
+        with self.assertRaises(RuntimeError):
+            self.coalescer.insert({'n': 1})
+        self.coalescer = InsertCoalescer(self.collection)
+
+    def test_custom_insert_many(self):
+        calls = []
+        def insert_many(documents, ordered=True):
+            calls.append(len(documents))
+            self.collection.insert_many(documents, ordered)
+        self.coalescer.close()
+        self.coalescer = InsertCoalescer(self.collection, max_delay=0.05, max_batch_size=10,
+                                         insert_many=insert_many)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            ids = list(executor.map(self.coalescer.insert, [{'n': i} for i in range(10)]))
+        self.assertEqual(10, len(set(ids)))
+        self.assertEqual(self.collection.batches, calls)
@@ -0,0 +1,90 @@
+import random
+import time
+import unittest
+
+from loadtest import parse_mix, percentile, compare, run_load, start_server, new_contact, Client, ServerProcess
+
+
+class LoadTestTest(unittest.TestCase):
+    def test_parse_mix(self):
+        self.assertEqual({'search': 3.0, 'add': 1.0}, parse_mix('search=3, add=1'))
+        with self.assertRaises(ValueError):
+            parse_mix('unknown=1')
+        with self.assertRaises(ValueError):
+            parse_mix('search=0')
+        with self.assertRaises(ValueError):
+            parse_mix('search=2,add=-1')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 0.5))
+        self.assertEqual(99, percentile(values, 0.99))
+        self.assertEqual(1, percentile([1], 0.99))
+        self.assertEqual(0.0, percentile([], 0.5))
+
+    def test_compare(self):
+        route = {'throughput': 100.0, 'error_rate': 0.0, 'p50_ms': 10.0, 'p95_ms': 20.0, 'p99_ms': 30.0}
+        baseline = {'routes': {'search': route}}
+        self.assertEqual([], compare(baseline, {'routes': {'search': dict(route, p99_ms=32.0)}}))
+        regressions = compare(baseline, {'routes': {'search': dict(route, p95_ms=30.0, throughput=50.0)}})
+        self.assertEqual(2, len(regressions))
+
+    def test_run_load(self):
+        server, url = start_server('memory', None)
+        try:
+            summary = run_load(url, parse_mix('search=1,add=1,delete=1'), concurrency=4,
+                               duration=0.5, seed_contacts=10)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertGreater(summary['requests'], 0)
+        for route in summary['routes'].values():
+            self.assertEqual(0, route['error_rate'])
+            self.assertLessEqual(route['p50_ms'], route['max_ms'])
+
+    def test_rate_mode_counts_queueing_delay(self):
+        # a server far slower than the target rate: requests pile up behind
+        # each other and that wait has to be part of the latency
+        from contactsmanager.server import app
+        server, url = start_server('memory', None)
+        backend = app.config['BACKEND']
+        search = backend.search_contacts_json
+
+        def slow_search(*args):
+            time.sleep(0.05)
+            return search(*args)
+
+        backend.search_contacts_json = slow_search
+        try:
+            summary = run_load(url, parse_mix('search=1'), concurrency=1, duration=0.5,
+                               rate=100, seed_contacts=0)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertGreater(summary['routes']['search']['max_ms'], 150)
+
+    def test_client_reuses_its_connection(self):
+        server, url = start_server('memory', None)
+        client = Client(url)
+        try:
+            self.assertEqual(200, client.request('POST', '/contacts/', new_contact(random.Random(0)))[0])
+            sock = client._connection.sock
+            self.assertEqual(404, client.request('GET', '/contacts/999/')[0])
+            self.assertEqual(200, client.request('GET', '/search/contacts/?firstname=a')[0])
+            self.assertIs(sock, client._connection.sock)
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_run_load_server_process(self):
+        server = ServerProcess('memory', 'unused')
+        try:
+            summary = run_load(server.url, parse_mix('search=1,add=1'), concurrency=2,
+                               duration=0.3, seed_contacts=5)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertGreater(summary['requests'], 0)
+        for route in summary['routes'].values():
+            self.assertEqual(0, route['error_rate'])
@@ -1,10 +1,16 @@
+import json
 import unittest
+import random
+import threading
+import time
 from copy import deepcopy
 
 from pymongo import MongoClient
 from bson.objectid import ObjectId
 
-from contactsmanager.model import Contact, Address, InMemoryBackend, MongoBackend
+import jsonpickle
+
+from contactsmanager.model import Contact, Address, InMemoryBackend, MongoBackend, ShardedBackend
 
 
 class ContactTest(unittest.TestCase):
@@ -53,6 +59,18 @@ class BaseTests:
         self._backend.update_contact(contact)
         self.assertEqual(self._contacts, [contact])
 
+    def test_update_fetched_contact(self):
+        contact = Contact(firstname='First', lastname='Last', emails=['bruno@bruno.com'],
+                         phone_numbers=['55-31-1234-4321'], addresses=[])
+        new_id = self._backend.add_contact(contact)
+        fetched = self._backend.get_contact(new_id)
+        fetched.firstname = 'Zed'
+        self._backend.update_contact(fetched)
+        self.assertEqual('Zed', self._backend.get_contact(new_id).firstname)
+        self.assertEqual(1, self._backend.count_contacts('z'))
+        self.assertEqual(0, self._backend.count_contacts('f'))
+        self.assertEqual({'Z': 1}, self._backend.facet_contacts()['firstname_initials'])
+
     def test_update_contact_not_available(self):
         contact = Contact(firstname='First', lastname='Last', emails=['bruno@bruno.com'],
                          phone_numbers=['55-31-1234-4321'], addresses=[])
@@ -89,9 +107,91 @@ class BaseTests:
     def test_get_contact_invalid_id(self):
         self.assertIsNone(self._backend.get_contact(self._invalid_id))
 
+    def test_get_contacts(self):
+        ids = []
+        contacts = []
+        for firstname in ('First', 'Second'):
+            contact = Contact(firstname=firstname, lastname='Last', emails=['bruno@bruno.com'],
+                             phone_numbers=['55-31-1234-4321'], addresses=[])
+            contact.contact_id = self._backend.add_contact(contact)
+            ids.append(contact.contact_id)
+            contacts.append(contact)
+        result = self._backend.get_contacts([ids[1], self._unavailable_id, ids[0], self._invalid_id, ids[1]])
+        self.assertEqual([contacts[1], None, contacts[0], None, contacts[1]], result)
+        self.assertTrue(self._backend.is_valid_id(self._unavailable_id))
+        self.assertFalse(self._backend.is_valid_id(self._invalid_id))
+
     def test_get_contact_not_available(self):
         self.assertIsNone(self._backend.get_contact(self._unavailable_id))
 
+class BaseChangesTests:
+    def test_get_changes(self):
+        contacts = []
+        for firstname in ('A', 'B', 'C'):
+            contact = Contact(firstname=firstname, lastname='Last', emails=['bruno@bruno.com'],
+                             phone_numbers=['55-31-1234-4321'], addresses=[])
+            contact.contact_id = self._backend.add_contact(contact)
+            contacts.append(contact)
+        a, b, c = contacts
+        a.firstname = 'NewA'
+        self._backend.update_contact(a)
+        self._backend.delete_contact(b.contact_id)
+
+        changes = self._backend.get_changes()
+        self.assertEqual([c.contact_id, a.contact_id, b.contact_id], [ch.contact_id for ch in changes])
+        self.assertEqual([c, a, None], [ch.contact for ch in changes])
+        self.assertEqual([False, False, True], [ch.deleted for ch in changes])
+        seqs = [ch.seq for ch in changes]
+        self.assertEqual(sorted(seqs), seqs)
+
+        first_page = self._backend.get_changes(0, 2)
+        self.assertEqual(changes[:2], first_page)
+        self.assertEqual(changes[2:], self._backend.get_changes(first_page[-1].seq, 2))
+        self.assertEqual([], self._backend.get_changes(changes[-1].seq))
+
+    def test_get_changes_concurrent_writers(self):
+        writers_count = 8
+        adds = 25
+        added = []
+        writers_done = threading.Event()
+
+        def writer(index):
+            for i in range(adds):
+                contact = Contact(firstname='W%d-%d' % (index, i), lastname='Last', emails=['bruno@bruno.com'],
+                                 phone_numbers=['55-31-1234-4321'], addresses=[])
+                added.append(self._backend.add_contact(contact))
+
+        # a paging reader that never rereads: whatever it pages past is gone
+        seen = []
+        def reader():
+            since = 0
+            while True:
+                done = writers_done.is_set()
+                changes = self._backend.get_changes(since, 7)
+                seen.extend(c.contact_id for c in changes)
+                if changes:
+                    since = changes[-1].seq
+                elif done:
+                    return
+
+        writers = [threading.Thread(target=writer, args=(i,)) for i in range(writers_count)]
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        writers_done.set()
+        reader_thread.join()
+        self.assertEqual(sorted(added), sorted(seen))
+
+    def test_get_changes_ignores_unavailable_ids(self):
+        self._backend.delete_contact(self._unavailable_id)
+        contact = Contact(contact_id=self._unavailable_id, firstname='First', lastname='Last',
+                          emails=['bruno@bruno.com'], phone_numbers=['55-31-1234-4321'], addresses=[])
+        self._backend.update_contact(contact)
+        self.assertEqual([], self._backend.get_changes())
+
 class BaseSearchTests:
     def baseSearchSetUp(self, backend):
         self.backend = backend
@@ -134,7 +234,70 @@ class BaseSearchTests:
         self.assertEqual([self.fourth], self.backend.search_contacts(firstname='fourth', lastname='contact'))
         self.assertEqual([], self.backend.search_contacts(firstname='f', lastname='contact1'))
 
-class InMemoryTest(unittest.TestCase, BaseTests):
+    def test_count(self):
+        self.assertEqual(4, self.backend.count_contacts())
+        self.assertEqual(2, self.backend.count_contacts('SOME'))
+        self.assertEqual(2, self.backend.count_contacts(lastname='con'))
+        self.assertEqual(2, self.backend.count_contacts('f', 'contact'))
+        self.assertEqual(0, self.backend.count_contacts('f', 'contact1'))
+        self.assertEqual(0, self.backend.count_contacts('z'))
+
+    def test_facets(self):
+        self.assertEqual(dict(count=4, firstname_initials={'F': 2, 'S': 2},
+                              lastname_initials={'C': 2, 'N': 1, 'R': 1}, states={}),
+                         self.backend.facet_contacts())
+        self.assertEqual(dict(count=2, firstname_initials={'F': 2},
+                              lastname_initials={'C': 2}, states={}),
+                         self.backend.facet_contacts('f'))
+        self.assertEqual(dict(count=1, firstname_initials={'S': 1},
+                              lastname_initials={'R': 1}, states={}),
+                         self.backend.facet_contacts(lastname='r'))
+        self.assertEqual(dict(count=0, firstname_initials={}, lastname_initials={}, states={}),
+                         self.backend.facet_contacts('f', 'contact1'))
+
+    def test_facets_follow_update_of_fetched_contact(self):
+        fetched = self.backend.get_contact(self.first.contact_id)
+        fetched.firstname = 'Sz'
+        self.backend.update_contact(fetched)
+        self.assertEqual(1, self.backend.count_contacts('f'))
+        self.assertEqual(3, self.backend.count_contacts('s'))
+        self.assertEqual(1, self.backend.count_contacts('sz'))
+        self.assertEqual({'F': 1, 'S': 3}, self.backend.facet_contacts()['firstname_initials'])
+        self.assertEqual(['Fourth', 'Someone', 'Someone', 'Sz'],
+                         [c.firstname for c in self.backend.search_contacts()])
+
+    def test_facets_non_ascii_initials(self):
+        contact = Contact(firstname='élodie', lastname='ørsted', emails=['bruno@bruno.com'],
+                         phone_numbers=['55-31-1234-4321'], addresses=[])
+        self.backend.add_contact(contact)
+        facets = self.backend.facet_contacts('é')
+        self.assertEqual({'É': 1}, facets['firstname_initials'])
+        self.assertEqual({'Ø': 1}, facets['lastname_initials'])
+
+    def test_facets_follow_changes(self):
+        self.first.addresses = [Address('s', 'c', 'AL'), Address('s2', 'c', 'AL'), Address('s', 'c', 'MG')]
+        self.backend.update_contact(self.first)
+        self.fourth.addresses = [Address('s', 'c', 'MG'), Address('s', 'c')]
+        self.backend.update_contact(self.fourth)
+        self.assertEqual({'AL': 1, 'MG': 2}, self.backend.facet_contacts()['states'])
+        self.assertEqual({'AL': 1, 'MG': 1}, self.backend.facet_contacts('fi')['states'])
+
+        self.backend.delete_contact(self.first.contact_id)
+        facets = self.backend.facet_contacts()
+        self.assertEqual(3, facets['count'])
+        self.assertEqual({'F': 1, 'S': 2}, facets['firstname_initials'])
+        self.assertEqual({'MG': 1}, facets['states'])
+        self.assertEqual(3, self.backend.count_contacts())
+
+    def test_facets_ignore_states_that_arent_strings(self):
+        self.first.addresses = [Address('s', 'c', {'x': 1}), Address('s', 'c', ['x']), Address('s', 'c', 'AL')]
+        self.backend.update_contact(self.first)
+        self.fourth.addresses = [Address('s', 'c', 5), Address('s', 'c', None)]
+        self.backend.update_contact(self.fourth)
+        self.assertEqual({'AL': 1}, self.backend.facet_contacts()['states'])
+        self.assertEqual({}, self.backend.facet_contacts('fo')['states'])
+
+class InMemoryTest(unittest.TestCase, BaseTests, BaseChangesTests):
     def setUp(self):
         self._backend = InMemoryBackend()
 
@@ -154,10 +317,128 @@ class InMemorySearchTest(unittest.TestCase, BaseSearchTests):
     def setUp(self):
         self.baseSearchSetUp(InMemoryBackend())
 
-class MongoBackendTest(unittest.TestCase, BaseTests):
+class InMemoryConcurrencyTest(unittest.TestCase):
+    def test_mixed_operations(self):
+        backend = InMemoryBackend()
+        threads_count = 16
+        iterations = 300
+        barrier = threading.Barrier(threads_count)
+        errors = []
+        kept_ids = [[] for _ in range(threads_count)]
+
+        def new_contact(firstname):
+            return Contact(firstname=firstname, lastname='Last', emails=['bruno@bruno.com'],
+                           phone_numbers=['55-31-1234-4321'], addresses=[])
+
+        def worker(index):
+            rnd = random.Random(index)
+            own_ids = []
+            barrier.wait()
+            try:
+                for i in range(iterations):
+                    operation = rnd.random()
+                    if operation < 0.3 or not own_ids:
+                        own_ids.append(backend.add_contact(new_contact('T%d-%d' % (index, i))))
+                    elif operation < 0.4:
+                        backend.delete_contact(own_ids.pop(rnd.randrange(len(own_ids))))
+                    elif operation < 0.5:
+                        contact = new_contact('U%d-%d' % (index, i))
+                        contact.contact_id = rnd.choice(own_ids)
+                        backend.update_contact(contact)
+                    elif operation < 0.7:
+                        contact_id = rnd.choice(own_ids)
+                        if backend.get_contact(contact_id).contact_id != contact_id:
+                            errors.append('wrong contact for %s' % contact_id)
+                    else:
+                        result = backend.search_contacts(rnd.choice(['', 't', 'u']))
+                        keys = [(c.firstname.lower(), c.lastname.lower()) for c in result]
+                        if keys != sorted(keys):
+                            errors.append('unsorted search result')
+            except Exception as e:
+                errors.append(repr(e))
+            kept_ids[index] = own_ids
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        expected_ids = sorted(contact_id for ids in kept_ids for contact_id in ids)
+        self.assertEqual(expected_ids, sorted(c.contact_id for c in backend.contacts))
+        self.assertEqual(expected_ids, sorted(c.contact_id for c in backend.search_contacts()))
+        for contact_id in expected_ids:
+            self.assertEqual(contact_id, backend.get_contact(contact_id).contact_id)
+        self.assertEqual(len(expected_ids), backend.facet_contacts()['count'])
+        self.assertEqual(len(expected_ids), backend.count_contacts('t') + backend.count_contacts('u'))
+        changes = backend.get_changes(0, threads_count * iterations)
+        self.assertEqual(expected_ids, sorted(c.contact_id for c in changes if not c.deleted))
+
+    def test_writes_scale_linearly(self):
+        contact = Contact(firstname='First', lastname='Last', emails=['bruno@bruno.com'],
+                          phone_numbers=['55-31-1234-4321'], addresses=[])
+
+        def time_adds(backend, count):
+            began = time.perf_counter()
+            for _ in range(count):
+                backend.add_contact(contact)
+            return time.perf_counter() - began
+
+        small = InMemoryBackend()
+        time_adds(small, 200)
+        large = InMemoryBackend()
+        time_adds(large, 20000)
+        # the same 1000 adds on a backend 100 times bigger; copying the
+        # collection on each write would make this ~100 times slower
+        self.assertLess(time_adds(large, 1000), time_adds(small, 1000) * 5)
+
+class ShardedTest(unittest.TestCase, BaseTests):
+    def setUp(self):
+        self._backend = ShardedBackend([InMemoryBackend() for _ in range(3)])
+
+    def tearDown(self):
+        self._backend.close()
+
+    @property
+    def _contacts(self):
+        return self._backend.search_contacts()
+
+    @property
+    def _unavailable_id(self):
+        return '0-10000'
+
+    @property
+    def _invalid_id(self):
+        return 'invalid'
+
+    def test_contacts_are_distributed(self):
+        for i in range(6):
+            contact = Contact(firstname='First%d' % i, lastname='Last', emails=['bruno@bruno.com'],
+                             phone_numbers=['55-31-1234-4321'], addresses=[])
+            self._backend.add_contact(contact)
+        self.assertEqual([2, 2, 2], [len(s.contacts) for s in self._backend._shards])
+
+    def test_close(self):
+        self._backend.close()
+        with self.assertRaises(RuntimeError):
+            self._backend.search_contacts()
+
+    def test_invalid_shard(self):
+        self.assertIsNone(self._backend.get_contact('3-1'))
+        self.assertIsNone(self._backend.get_contact('x-1'))
+
+class ShardedSearchTest(unittest.TestCase, BaseSearchTests):
+    def setUp(self):
+        self.baseSearchSetUp(ShardedBackend([InMemoryBackend() for _ in range(3)]))
+
+    def tearDown(self):
+        self.backend.close()
+
+class MongoBackendTest(unittest.TestCase, BaseTests, BaseChangesTests):
     def setUp(self):
         self._mongo = MongoClient('mongodb://127.0.0.1:27017')
-        self._backend = MongoBackend(self._mongo.contactsmanager_test)
+        self._backend = MongoBackend(self._mongo.contactsmanager_test, record_changes=True)
 
     def tearDown(self):
         self._mongo.drop_database('contactsmanager_test')
@@ -175,6 +456,52 @@ class MongoBackendTest(unittest.TestCase, BaseTests):
     def _contacts(self):
         return self._backend.all_contacts()
 
+class MongoBackendCoalescingTest(MongoBackendTest):
+    def setUp(self):
+        self._mongo = MongoClient('mongodb://127.0.0.1:27017')
+        self._backend = MongoBackend(self._mongo.contactsmanager_test, coalesce_writes=True,
+                                     record_changes=True)
+
+    def tearDown(self):
+        self._backend.close()
+        super().tearDown()
+
+class MongoJsonMappingTest(unittest.TestCase):
+    # no server needed: the client only connects on the first query
+    def setUp(self):
+        self._mongo = MongoClient('mongodb://127.0.0.1:27017', connect=False)
+        self._backend = MongoBackend(self._mongo.contactsmanager_test)
+
+    def tearDown(self):
+        self._mongo.close()
+
+    _documents = [
+        {'_id': ObjectId(), 'contact_id': None, 'firstname': 'Zé', 'lastname': 'Last',
+         'firstname_lower': 'zé', 'lastname_lower': 'last', 'birthdate': '1975-11-02',
+         'emails': ['bruno@bruno.com'], 'phone_numbers': ['55-31-1234-4321'],
+         'addresses': [{'street': 'street', 'city': 'city', 'state': 'AL', 'zipcode': '12345'}]},
+        {'lastname_lower': 'other', 'addresses': [{'city': 'city', 'street': 'street'}],
+         'firstname': 'First', 'lastname': 'Other', '_id': ObjectId(), 'emails': ['a@b.com'],
+         'phone_numbers': ['1'], 'firstname_lower': 'first'},
+    ]
+
+    def _expected(self):
+        return jsonpickle.dumps([self._backend._map_contact(deepcopy(d)) for d in self._documents], unpicklable=False)
+
+    def _actual(self):
+        return self._backend._dumps([self._backend._map_contact_json(d) for d in self._documents])
+
+    @unittest.skipUnless(jsonpickle.__version__ == '0.9.5', 'the output is only fixed for the pinned jsonpickle')
+    def test_same_output_as_model_objects(self):
+        self.assertEqual(self._expected(), self._actual())
+
+    def test_same_content_as_model_objects(self):
+        self.assertEqual(json.loads(self._expected()), json.loads(self._actual()))
+
+    def test_changes_are_opt_in(self):
+        with self.assertRaises(NotImplementedError):
+            self._backend.get_changes()
+
 class MongoBackendSearchTest(unittest.TestCase, BaseSearchTests):
     def setUp(self):
         self._mongo = MongoClient('mongodb://127.0.0.1:27017')
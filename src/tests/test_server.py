@@ -5,7 +5,7 @@ from flask import json
 import jsonpickle
 
 from contactsmanager.server import app
-from contactsmanager.model import InMemoryBackend, Contact, Address
+from contactsmanager.model import InMemoryBackend, ShardedBackend, Contact, Address
 
 dumps = lambda o: jsonpickle.dumps(o, unpicklable=False)
 to_dict = lambda o: deepcopy(json.loads(dumps(o)))
@@ -70,6 +70,43 @@ class TestServer(unittest.TestCase):
         contacts = search('fo', 'c')
         self.assertEqual(contacts, n([self.fourth]))
 
+    def test_changes(self):
+        backend = app.config['BACKEND']
+        for contact in self.contacts:
+            new_id = backend.add_contact(contact)
+            contact.contact_id = new_id
+        backend.delete_contact(self.random.contact_id)
+
+        response = self.app.get('/changes/', query_string={'since': 0, 'limit': 3})
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.data)
+        n = lambda c: json.loads(dumps(c))
+        self.assertEqual([c['contact'] for c in content['changes']], n([self.first, self.not_random, self.fourth]))
+        self.assertEqual(content['last_seq'], content['changes'][-1]['seq'])
+
+        response = self.app.get('/changes/', query_string={'since': content['last_seq']})
+        content = json.loads(response.data)
+        self.assertEqual(len(content['changes']), 1)
+        self.assertEqual(content['changes'][0]['contact_id'], self.random.contact_id)
+        self.assertTrue(content['changes'][0]['deleted'])
+
+        response = self.app.get('/changes/', query_string={'since': content['last_seq']})
+        content = json.loads(response.data)
+        self.assertEqual(content['changes'], [])
+
+    def test_changes_not_available(self):
+        app.config['BACKEND'] = ShardedBackend([InMemoryBackend(), InMemoryBackend()])
+        try:
+            response = self.app.get('/changes/')
+            self.assertEqual(response.status_code, 501)
+        finally:
+            app.config['BACKEND'].close()
+
+    def test_changes_invalid_input(self):
+        for query_string in ({'since': 'x'}, {'limit': 'x'}, {'since': -1}, {'limit': 0}):
+            response = self.app.get('/changes/', query_string=query_string)
+            self.assertEqual(response.status_code, 400)
+
     def test_add_contact(self):
         response = self.app.post('/contacts/', data=dumps(self.first))
         content = json.loads(response.data)
@@ -106,6 +143,90 @@ class TestServer(unittest.TestCase):
         response = self.app.post('/contacts/', data=dumps(first))
         self.assertEqual(response.status_code, 400)
 
+    def test_count_and_facets(self):
+        for contact in self.contacts:
+            new_id = app.config['BACKEND'].add_contact(contact)
+            contact.contact_id = new_id
+
+        response = self.app.get('/search/contacts/count/', query_string={'firstname': 's'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {'count': 2})
+
+        response = self.app.get('/search/contacts/facets/', query_string={'lastname': 'c'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {
+            'count': 2,
+            'firstname_initials': {'F': 2},
+            'lastname_initials': {'C': 2},
+            'states': {'AL': 2},
+        })
+
+    def test_facets_with_states_that_arent_strings(self):
+        for state in ({'x': 1}, ['x'], 5):
+            contact = to_dict(self.first)
+            contact['addresses'][0]['state'] = state
+            response = self.app.post('/contacts/', data=dumps(contact))
+            self.assertEqual(response.status_code, 200)
+        app.config['BACKEND'].add_contact(self.fourth)
+
+        response = self.app.get('/search/contacts/facets/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['states'], {'AL': 1})
+
+    def test_get_contact(self):
+        for contact in self.contacts:
+            new_id = app.config['BACKEND'].add_contact(contact)
+            contact.contact_id = new_id
+
+        response = self.app.get('/contacts/%s/' % self.fourth.contact_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode(), dumps(self.fourth))
+
+    def test_get_contact_doesnt_exist(self):
+        response = self.app.get('/contacts/10000/')
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get('/contacts/invalid/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_batch_get(self):
+        for contact in self.contacts:
+            new_id = app.config['BACKEND'].add_contact(contact)
+            contact.contact_id = new_id
+
+        ids = [self.fourth.contact_id, 10000, self.first.contact_id, 'invalid']
+        response = self.app.post('/contacts/batch-get/', data=dumps({'ids': ids}))
+        self.assertEqual(response.status_code, 200)
+
+        content = json.loads(response.data)
+        n = lambda c: json.loads(dumps(c))
+        self.assertEqual(content['contacts'], n([self.fourth, self.first]))
+        self.assertEqual(content['missing'], [10000])
+        self.assertEqual(content['invalid'], ['invalid'])
+
+    def test_batch_get_non_id_values(self):
+        for contact in self.contacts:
+            new_id = app.config['BACKEND'].add_contact(contact)
+            contact.contact_id = new_id
+
+        ids = [None, True, 1.7, str(self.first.contact_id)]
+        response = self.app.post('/contacts/batch-get/', data=dumps({'ids': ids}))
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.data)
+        n = lambda c: json.loads(dumps(c))
+        self.assertEqual(content['contacts'], n([self.first]))
+        self.assertEqual(content['missing'], [])
+        self.assertEqual(content['invalid'], [None, True, 1.7])
+
+    def test_batch_get_invalid_input(self):
+        response = self.app.post('/contacts/batch-get/', data="I'm not a json")
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/contacts/batch-get/', data=dumps({'ids': 'invalid'}))
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/contacts/batch-get/', data=dumps({'ids': list(range(1001))}))
+        self.assertEqual(response.status_code, 400)
+        response = self.app.post('/contacts/batch-get/', data=dumps({'ids': list(range(1000))}))
+        self.assertEqual(response.status_code, 200)
+
     def test_delete_contact(self):
         for contact in self.contacts:
             new_id = app.config['BACKEND'].add_contact(contact)